@@ -1,97 +1,196 @@
+import hashlib
 import json
 import logging
 import os
 import re
 import sys
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from math import floor
 from zipfile import ZipFile
-import glob
 from optparse import OptionParser
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 LOGGER = logging.getLogger(__name__)
 
+_FORMAT_RE = re.compile(r"osu file format (.+)")
+_NUM_RE = re.compile(r"-?\d+(\.\d+)?\Z")
+_OBJ_SECTION_RE = re.compile(rb"^\[(Events|TimingPoints|HitObjects)\]", re.MULTILINE)
+
+_PARSE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "bms_conv_cache")
+
+# there can be tens of thousands of these per chart, a tuple is much smaller than a dict
+ManiaHitObject = namedtuple(
+    "ManiaHitObject", ["lane", "time", "ln", "time_end", "hitSound", "sample"]
+)
 
-def unzip_osz(filepath, dst):
+
+def osz_dstpath(filepath, dst):
+    """Makes the folder the charts and assets of an osz are written to"""
     filename, ext = os.path.splitext(filepath)
     dstpath = os.path.join(dst, os.path.basename(filename))
     LOGGER.info(dstpath)
+    if not os.path.exists(dstpath):
+        os.mkdir(dstpath)
+
+    return dstpath
+
+
+def read_osz_charts(filepath):
+    """Reads the .osu charts of an osz archive into memory, returns {name: bytes}"""
+    with ZipFile(filepath, "r") as z:
+        return {
+            name: z.read(name) for name in z.namelist() if name.lower().endswith(".osu")
+        }
+
+
+def unzip_osz(filepath, dstpath, files):
+    """Extracts only the given files (as referenced by the charts) from the osz archive
+
+    osu! looks files up case insensitively, so the names are matched the same way
+    """
+    wanted = {f.replace("\\", "/").lower() for f in files}
     with ZipFile(filepath, "r") as z:
-        if not os.path.exists(dstpath):
-            os.mkdir(dstpath)
-        z.extractall(path=dstpath)
+        members = [m for m in z.namelist() if m.lower() in wanted]
+        z.extractall(path=dstpath, members=members)
 
     return dstpath
 
 
-def get_beatmap_data(filepath):
-    """Reads osu file and returns metadata. Cannot use ini parser reliably as it is not a proper INI file
+def _skip_section(lines, section, metadata, objs, parsers):
+    pass
 
-    Sometimes the osu file leaves comments, so it is more reliable to parse this section manually and
-    get the information that we need
 
-    Top sections contain metadata with key:val split
-    Bottom sections are a list of objects with ,: separated parameters
+def _parse_keyval_section(lines, section, metadata, objs, parsers):
+    for line in lines:
+        if not line or line.startswith(b"//"):
+            continue
+        key, _, val = line.decode().partition(":")
+        metadata[key.strip()] = val.strip()
+
+
+def _parse_params_section(lines, section, metadata, objs, parsers):
+    rows = objs[section] = []
+    parse = parsers.get(section)
+    for line in lines:
+        if not line or line.startswith(b"//"):
+            continue
+        # object rows stay as bytes, the parsers only decode the fields that are text
+        vals = line.split(b",")
+        rows.append(parse(vals) if parse else vals)
+
+
+# how each [Section] is read, anything not listed is key:val metadata
+# everything events and below is object list
+_SECTION_HANDLERS = {
+    "Editor": _skip_section,
+    "Events": _parse_params_section,
+    "TimingPoints": _parse_params_section,
+    "HitObjects": _parse_params_section,
+}
+
+
+def _parse_beatmap_sections(data, metadata, objs, parsers):
+    """Parses the [Section]s of .osu contents into metadata and objs, see get_beatmap_data
+
+    The sections are split apart in one go, then each one is handed to its handler so nothing
+    is dispatched per line
     """
-    f = open(filepath, "rb")
-    f.seek(0)
+    # anything before the first header (the format line) is not part of a section
+    for chunk in (b"\n" + data).split(b"\n[")[1:]:
+        section, _, body = chunk.partition(b"]")
+        section = section.decode()
+        handler = _SECTION_HANDLERS.get(section, _parse_keyval_section)
+
+        # the rest of the header line is not part of the section
+        handler(body.splitlines()[1:], section, metadata, objs, parsers)
+
+
+def _object_sections_start(data):
+    """Index into data of the first object section header, or the end if there are none"""
+    matches = _OBJ_SECTION_RE.search(data)
+    return matches.start() if matches else len(data)
+
 
+def get_beatmap_metadata(data):
+    """Reads only the metadata sections above the object sections of the osu file contents
+
+    This is cheap compared to parsing the objects, so charts can be checked before doing that
+    """
+    head = data[: _object_sections_start(data)]
     metadata = {}
-    objs = {}
 
     # first line is osu file format
-    metadata["format"] = re.match("osu file format (.+)", f.readline().decode()).group(
-        1
-    )
+    metadata["format"] = _FORMAT_RE.match(head.splitlines()[0].decode()).group(1)
     LOGGER.info(f"Got file format {metadata['format']}")
 
-    obj_headers = ["Events", "TimingPoints", "HitObjects"]
+    _parse_beatmap_sections(head, metadata, {}, {})
+    return metadata
 
-    # 0 = skip, 1 = keyval, 2 = parameterlist
-    linefmt = 1
-    section = None
-    for line in f:
-        line = line.decode()
-        line = line.strip("\r\n")
-        if re.match("\/\/", line) or not line or line == "":
-            continue
 
-        # anything with obj lists
-        obj_headers = ["Events", "TimingPoints", "HitObjects"]
+def get_beatmap_objects(data, parsers=None):
+    """Reads the object sections of the osu file contents, see get_beatmap_data"""
+    objs = {}
 
-        # [Section] header
-        matches = re.match("\[(.+)\]", line)
-        if matches and matches.group(1):
-            section = matches.group(1)
+    # metadata sections mixed in with the objects (e.g. [Colours]) are not needed
+    _parse_beatmap_sections(data[_object_sections_start(data) :], {}, objs, parsers or {})
+    return objs
 
-            if section == "Editor":
-                linefmt = 0
 
-            # everything events and below is object list
-            elif section in obj_headers:
-                linefmt = 2
-                objs[section] = []
+def get_beatmap_data(data, parsers=None):
+    """Reads osu file contents and returns metadata. Cannot use ini parser reliably as it is not a proper INI file
 
-            else:
-                linefmt = 1
+    Sometimes the osu file leaves comments, so it is more reliable to parse this section manually and
+    get the information that we need
+
+    Top sections contain metadata with key:val split
+    Bottom sections are a list of objects with ,: separated parameters
+
+    parsers optionally maps an object section to fn(params), which is applied to each line as it
+    is read so the section holds the parsed objects instead of raw lists of bytes parameters
+    """
+    return get_beatmap_metadata(data), get_beatmap_objects(data, parsers)
+
+
+def _parse_cache_file(data):
+    """Cache file for the parse of data, changes whenever the .osu contents or this script do"""
+    key = hashlib.sha1(data)
+    key.update(str(os.stat(__file__).st_mtime_ns).encode())
+    return os.path.join(_PARSE_CACHE_DIR, f"{key.hexdigest()}.json")
+
+
+def _load_parse_cache(cachefile):
+    try:
+        with open(cachefile, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-        elif linefmt == 0:
-            continue
-        elif linefmt == 1:
-            key, val = list(map(lambda x: x.strip(" "), line.split(":")))
-            metadata[key] = val
-        elif linefmt == 2:
-            vals = list(map(lambda x: x.strip(" "), line.split(",")))
-            objs[section].append(vals)
-    return metadata, objs
+
+def _store_parse_cache(cachefile, parsed):
+    # write then rename so a concurrent reader never sees a partial file
+    try:
+        os.makedirs(_PARSE_CACHE_DIR, exist_ok=True)
+        tmpfile = f"{cachefile}.{os.getpid()}.tmp"
+        with open(tmpfile, "w") as f:
+            json.dump(parsed, f)
+        os.replace(tmpfile, cachefile)
+    except OSError as e:
+        LOGGER.warning(f"Could not write parse cache {cachefile}: {e}")
 
 
 def sanitise_metadata(m):
     for k, v in m.items():
-        for fn in (int, float):
-            try:
-                m[k] = fn(v)
-            except:
-                continue
+        # only numeric looking values are converted, strings stay as they are
+        matches = _NUM_RE.match(v)
+        if matches:
+            m[k] = float(v) if matches.group(1) else int(v)
 
     return m
 
@@ -104,13 +203,13 @@ def sanitise_event(e):
 
     ret["startTime"] = float(e[1])
 
-    if e[0] == "0":
+    if e[0] == b"0":
         ret["eventType"] = "bg"
-        ret["file"] = e[2].strip('"')
+        ret["file"] = e[2].strip(b'"').decode()
         ret["x"] = int(e[3])
         ret["y"] = int(e[4])
     else:
-        LOGGER.error(f"Unsupported event {e[0]}")
+        LOGGER.error(f"Unsupported event {e[0].decode()}")
         ret["eventType"] = "unsupported"
 
     # not supporting anything else right now
@@ -120,7 +219,7 @@ def sanitise_event(e):
 def sanitise_timing(e):
     ret = {}
 
-    ret["uninherited"] = True if e[6] == "1" else False
+    ret["uninherited"] = True if e[6] == b"1" else False
 
     # this can either be measure value, or SV change
     if ret["uninherited"]:
@@ -139,24 +238,21 @@ def sanitise_timing(e):
 
 
 def sanitise_mania_hitobj(e, n):
-    ret = {}
-
-    ret["lane"] = floor(int(e[0]) * n / 512)
-    ret["time"] = int(e[2])
     type_int = int(e[3])
 
     # note last variable is empty as .osu has trailing :
-    tail = e[5].split(":")
-
-    if (type_int >> 0) & 1:
-        ret["ln"] = False
-    elif (type_int >> 7) & 1:
-        ret["ln"] = True
-        ret["time_end"] = int(tail[0])
-    ret["hitSound"] = int(e[4])
-    ret["sample"] = tail[-2]
-
-    return ret
+    tail = e[5].split(b":")
+
+    # bit 0 = normal note, bit 7 = hold note
+    ln = not ((type_int >> 0) & 1) and bool((type_int >> 7) & 1)
+    return ManiaHitObject(
+        lane=int(e[0]) * n // 512,
+        time=int(e[2]),
+        ln=ln,
+        time_end=int(tail[0]) if ln else None,
+        hitSound=int(e[4]),
+        sample=tail[-2].decode(),
+    )
 
 
 def _measure_time_from_bpm(bpm):
@@ -175,7 +271,7 @@ def mania_calc_offset(timings):
     (this would be 1/beatLength * 1000 * 60)
     """
 
-    first_timing = [x for x in timings if x["uninherited"]][0]
+    first_timing = next(x for x in timings if x["uninherited"])
     initial_bpm = _bpm_from_measure_time(first_timing["beatLength"])
     LOGGER.info(f"Got first timing BPM {initial_bpm}")
 
@@ -208,35 +304,38 @@ def _mania_ms_to_pulse(ms, measure_ms, resolution):
     return measure_pulse
 
 
-def bmson_gen_note(maniaobj, beat_ms, time_offset):
-    """Generate bmson note from osumania objects and timings"""
-    note = {}
-    note["x"] = maniaobj["lane"] + 1
+def bmson_gen_note(maniaobj, beat_ms, time_offset, obj_offset=0):
+    """Generate bmson note from osumania objects and timings
 
-    note["y"] = _mania_ms_to_pulse(maniaobj["time"] - time_offset, beat_ms, 240)
-    note["y"] = int(round(note["y"], 1))
+    obj_offset is added to the hitobject times, so the hitobjects do not have to be rebuilt
+    with the chart offset applied
+    """
+    # same maths as _mania_ms_to_pulse at 240 resolution, inlined as this runs once per note
+    # pulses are rounded to the nearest whole pulse
+    time = maniaobj.time + obj_offset
+    note = {"x": maniaobj.lane + 1}
+    note["y"] = floor((time - time_offset) / beat_ms * 240 + 0.5)
 
-    if not maniaobj["ln"]:
+    if not maniaobj.ln:
         note["l"] = 0
     else:
-        diff = maniaobj["time_end"] - maniaobj["time"]
-        note["l"] = _mania_ms_to_pulse(diff, beat_ms, 240)
-        note["l"] = int(round(note["l"], 1))
+        time_end = maniaobj.time_end + obj_offset
+        note["l"] = floor((time_end - time) / beat_ms * 240 + 0.5)
 
     return note
 
 
-def bmson_group_mania_soundchannels(hitobjs, timings, hitsounds):
-    """bmson format groups notes with the same hitsounds together"""
+def bmson_group_mania_soundchannels(hitobjs, timings, hitsounds, obj_offset=0):
+    """bmson format groups notes with the same hitsounds together
 
-    timings_i = iter(timings)
+    obj_offset is the offset already applied to timings that still needs adding to hitobjs
+    """
 
     # current timing reference = at x time, y beats per measure
-    c_timing_ref = next(timings_i, None)
-    c_next_ref = next(timings_i, None)
-    if not c_timing_ref:
+    if not timings:
         LOGGER.error("No timings in list")
         return
+    c_timing_ref = timings[0]
 
     if not c_timing_ref["uninherited"]:
         LOGGER.error("Expected first timing point to be uninherited")
@@ -249,16 +348,21 @@ def bmson_group_mania_soundchannels(hitobjs, timings, hitsounds):
     total_pulses = _mania_ms_to_pulse(c_timing_ref["time"], measure_ms, 240)
 
     sound_channels = []
+    channels_by_name = {}
     default_channel = {"name": "0", "notes": []}
     bpm_events = []
 
+    # hitobjs and timings are both sorted by time in .osu files, so a single index into
+    # timings is advanced past every timing point at or before the current note
+    ti = 0
     for o in hitobjs:
-        if c_next_ref and c_next_ref["time"] <= o["time"]:
+        while ti + 1 < len(timings) and timings[ti + 1]["time"] <= o.time + obj_offset:
+            ti += 1
+            c_next_ref = timings[ti]
             time_diff = c_next_ref["time"] - c_timing_ref["time"]
             total_pulses += _mania_ms_to_pulse(time_diff, measure_ms, 240)
 
             c_timing_ref = c_next_ref
-            c_next_ref = next(timings_i, None)
 
             if not c_timing_ref["uninherited"]:
                 target_ref_ms = ref_measure_ms
@@ -273,22 +377,20 @@ def bmson_group_mania_soundchannels(hitobjs, timings, hitsounds):
                 measure_ms = target_ms
                 ref_measure_ms = target_ref_ms
 
-
             bpm_event = {"y": total_pulses, "bpm": _bpm_from_measure_time(measure_ms)}
             bpm_events.append(bpm_event)
 
-        sample = o["sample"]
+        sample = o.sample
         if sample != "0" and hitsounds:
-            channel_obj = next(
-                filter(lambda x: x["name"] == sample, sound_channels), None
-            )
+            channel_obj = channels_by_name.get(sample)
         else:
             channel_obj = default_channel
         if not channel_obj:
             channel_obj = {"name": sample, "notes": []}
+            channels_by_name[sample] = channel_obj
             sound_channels.append(channel_obj)
 
-        note_obj = bmson_gen_note(o, measure_ms, c_timing_ref["time"])
+        note_obj = bmson_gen_note(o, measure_ms, c_timing_ref["time"], obj_offset)
         note_obj["y"] += total_pulses
         channel_obj["notes"].append(note_obj)
 
@@ -332,40 +434,60 @@ def bmson_gen_bga(bg):
     return bga
 
 
-def convert_mania_chart(filepath, dstpath, extra_offset, hitsounds):
-    LOGGER.info(f"Converting {filepath}")
-    chart_data, chart_objs = get_beatmap_data(filepath)
+def write_bmson(bmson, dstfile, indent=False):
+    """Writes the bmson, using orjson if it is installed as it is much faster than json"""
+    if orjson:
+        with open(dstfile, "wb") as f:
+            f.write(orjson.dumps(bmson, option=orjson.OPT_INDENT_2 if indent else 0))
+    else:
+        with open(dstfile, "w") as f:
+            json.dump(bmson, f, indent=2 if indent else None)
+
 
-    # sanitise collected data
-    chart_data = sanitise_metadata(chart_data)
+def convert_mania_chart(filepath, data, dstpath, extra_offset, hitsounds, indent=False):
+    """Converts the .osu contents in data and writes the bmson to dstpath
+
+    Returns the files the bmson references (audio, images, samples) so they can be extracted
+    beside it, nothing is referenced if the chart was not converted
+    """
+    LOGGER.info(f"Converting {filepath}")
+    chart_data = sanitise_metadata(get_beatmap_metadata(data))
 
+    # only the metadata is needed to skip a chart, so check before parsing any objects
     if chart_data["CircleSize"] != 7:
-        return
+        return []
 
-    chart_events_all = list(map(sanitise_event, chart_objs["Events"]))
-    chart_events = list(filter(lambda x: x["eventType"] != "unused", chart_events_all))
-    chart_timings = list(map(sanitise_timing, chart_objs["TimingPoints"]))
-    chart_hitobjs = list(
-        map(
-            lambda x: sanitise_mania_hitobj(x, chart_data["CircleSize"]),
-            chart_objs["HitObjects"],
-        )
-    )
+    # objects are sanitised as they are read
+    parsers = {
+        "Events": sanitise_event,
+        "TimingPoints": sanitise_timing,
+        "HitObjects": lambda e: sanitise_mania_hitobj(e, chart_data["CircleSize"]),
+    }
+    cachefile = _parse_cache_file(data)
+    chart_objs = _load_parse_cache(cachefile)
+    if chart_objs:
+        LOGGER.info(f"Using cached parse {cachefile}")
+        # the cache stores the hitobject tuples as plain lists
+        chart_objs["HitObjects"] = [ManiaHitObject(*o) for o in chart_objs["HitObjects"]]
+    else:
+        chart_objs = get_beatmap_objects(data, parsers)
+        _store_parse_cache(cachefile, chart_objs)
+
+    chart_events = [e for e in chart_objs["Events"] if e["eventType"] != "unused"]
+    chart_timings = chart_objs["TimingPoints"]
+    chart_hitobjs = chart_objs["HitObjects"]
 
     # calculate offset for measures
     bpm, offset = mania_calc_offset(chart_timings)
     bpm = round(bpm, 3)
     offset = round(offset, 3)
 
-    chart_hitobjs = list(
-        map(lambda x: mania_add_offset(x, offset + extra_offset), chart_hitobjs)
-    )
-    chart_timings = list(
-        map(lambda x: mania_add_offset(x, offset + extra_offset), chart_timings)
-    )
+    # timings are shifted in place, hitobjs get the same offset when their notes are made
+    total_offset = offset + extra_offset
+    for timing in chart_timings:
+        mania_add_offset(timing, total_offset)
 
-    for i in chart_hitobjs[0:5]:
-        print(i)
+    LOGGER.debug(f"First hitobjects {chart_hitobjs[0:5]}")
 
     """BMS Chart processing"""
     # make info dictionary
@@ -373,14 +495,16 @@ def convert_mania_chart(filepath, dstpath, extra_offset, hitsounds):
 
     # add timing data
     info["init_bpm"] = bpm
-    bg = next(filter(lambda x: x["eventType"] == "bg", chart_events), "")["file"]
+    bg = next((e["file"] for e in chart_events if e["eventType"] == "bg"), "")
     info["eyecatch_image"] = bg
     info["back_image"] = bg
 
-    print(info)
+    LOGGER.debug(f"Info {info}")
 
     # make sound channels
-    channels, bpm_events = bmson_group_mania_soundchannels(chart_hitobjs, chart_timings, hitsounds)
+    channels, bpm_events = bmson_group_mania_soundchannels(
+        chart_hitobjs, chart_timings, hitsounds, total_offset
+    )
 
     # calc pulse for first audio
     first_length = chart_timings[0]["beatLength"]
@@ -401,8 +525,9 @@ def convert_mania_chart(filepath, dstpath, extra_offset, hitsounds):
 
     filebase = os.path.basename(filepath)
     dstfile = os.path.join(dstpath, f"{filebase}.bmson")
-    with open(dstfile, "w") as f:
-        json.dump(bmson, f, indent=2)
+    write_bmson(bmson, dstfile, indent)
+
+    return [bg] + [c["name"] for c in channels]
 
 
 if __name__ == "__main__":
@@ -419,6 +544,14 @@ if __name__ == "__main__":
         default=False,
         help="make dedicated hitsound channels, default off",
     )
+    parser.add_option(
+        "-i",
+        "--indent",
+        dest="indent",
+        action="store_true",
+        default=False,
+        help="indent the bmson output for reading, default off",
+    )
     parser.add_option(
         "-p",
         "--present",
@@ -444,7 +577,24 @@ if __name__ == "__main__":
 
     """Mania chart processing"""
     # get raw data of beatmap
-    dstfolder = unzip_osz(opt.osz, opt.dst)
-    LOGGER.info(dstfolder)
-    for file in glob.glob(f"{dstfolder}/*.osu"):
-        convert_mania_chart(file, dstfolder, offset, opt.hitsounds)
+    dstfolder = osz_dstpath(opt.osz, opt.dst)
+    charts = read_osz_charts(opt.osz)
+
+    # each difficulty converts independently, so spread them over processes
+    convert = partial(
+        convert_mania_chart,
+        dstpath=dstfolder,
+        extra_offset=offset,
+        hitsounds=opt.hitsounds,
+        indent=opt.indent,
+    )
+    assets = set()
+    workers = min(len(charts), os.cpu_count() or 1) or 1
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=partial(logging.basicConfig, level=logging.INFO)
+    ) as ex:
+        for files in ex.map(convert, charts.keys(), charts.values()):
+            assets.update(files)
+
+    # only the files the converted charts use need to be on disk
+    unzip_osz(opt.osz, dstfolder, assets)